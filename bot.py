@@ -1,11 +1,25 @@
 from telegram import Update
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, filters, CommandHandler
 import os
+import re
+import asyncio
 import logging
+import json
+import queue
+import time
+import tempfile
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import httpx
 import yt_dlp
-from datetime import datetime
-from typing import Optional
+from yt_dlp.networking import Request
+from yt_dlp.networking.exceptions import HTTPError, SSLError, TransportError
+from yt_dlp.utils import DownloadError, ExtractorError
+from pathlib import Path
+from typing import NamedTuple, Optional
 
 # Load environment variables
 load_dotenv()
@@ -17,54 +31,366 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# yt-dlp blocks (network + ffmpeg), so downloads run off the event loop
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="ytdl")
+
+def is_backpressure(exc: BaseException) -> bool:
+    """True for upstream overload signals: timeouts, connection errors, HTTP 429/5xx"""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, HTTPError):
+            return exc.status == 429 or exc.status >= 500
+        if isinstance(exc, (TimeoutError, TransportError)) and not isinstance(exc, SSLError):
+            return True
+        # yt-dlp wraps the real failure in DownloadError / ExtractorError
+        if isinstance(exc, DownloadError) and exc.exc_info:
+            exc = exc.exc_info[1]
+        elif isinstance(exc, ExtractorError) and exc.cause:
+            exc = exc.cause
+        else:
+            exc = exc.__cause__ or exc.__context__
+    return False
+
+class AdaptiveLimiter:
+    """Concurrency limit that shrinks when TikTok slows down or fails"""
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.in_flight = 0
+        self.avg_latency: Optional[float] = None
+        self._cond = asyncio.Condition()
+
+    def locked(self) -> bool:
+        return self.in_flight >= self.limit
+
+    def _record(self, latency: Optional[float], ok: bool):
+        """Adjust the limit after a download that TikTok either served or pushed back on"""
+        if not ok:
+            self.limit = max(1, self.limit // 2)
+        elif latency is not None and self.avg_latency is not None and latency > 2 * self.avg_latency:
+            self.limit = max(1, self.limit - 1)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1)
+        if ok and latency is not None:
+            self.avg_latency = latency if self.avg_latency is None else 0.9 * self.avg_latency + 0.1 * latency
+        logger.debug("Download limit %d (latency %s, ok=%s)", self.limit, latency, ok)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold a download slot; callers put a size-independent 'latency' in the yielded dict"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        sample = {}
+        # None means a neutral outcome (bad link, too large, Telegram error)
+        ok = None
+        try:
+            yield sample
+            ok = True
+        except Exception as e:
+            if is_backpressure(e):
+                ok = False
+            raise
+        finally:
+            if ok is not None:
+                self._record(sample.get('latency'), ok)
+            async with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+# Bursts of links wait here instead of all hitting TikTok at once
+download_limiter = AdaptiveLimiter(DOWNLOAD_WORKERS)
+
+# Compiled once at import: TIKTOK_URL_RE finds the link (it is the handler filter),
+# VIDEO_ID_RE pulls out a numeric video ID, SHORT_LINK_RE spots links to resolve first
+TIKTOK_URL_RE = re.compile(r'(?:https?://)?(?<![\w.-])(?:www\.|vm\.|vt\.|m\.)?tiktok\.com/\S+')
+VIDEO_ID_RE = re.compile(r'tiktok\.com/(?:@[^/\s]+/video|v|embed/v2|embed|share/video)/(\d+)')
+SHORT_LINK_RE = re.compile(r'(?:vm|vt)\.tiktok\.com/\w+|tiktok\.com/t/\w+')
+
+def extract_video_id(url: str) -> Optional[str]:
+    """Return the numeric video ID from a TikTok URL"""
+    match = VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+YDL_OPTS = {
+    'format': 'best',
+    # TikTok formats are all MP4, but yt-dlp ranks H.265 above H.264 by default;
+    # prefer the H.264 file so it plays everywhere and needs no ffmpeg pass
+    'format_sort': ['vcodec:h264', 'ext:mp4'],
+    # Skip yt-dlp's own console output and progress rendering
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,
+    'merge_output_format': 'mp4',
+    # The adaptive limiter handles backpressure, so keep retries short
+    'retries': 2,
+    'fragment_retries': 2,
+    'extractor_retries': 2,
+}
+
+class YoutubeDLPool:
+    """Reuses YoutubeDL instances so extractor setup isn't paid per download"""
+    def __init__(self, opts: dict):
+        self.opts = opts
+        self._idle = queue.SimpleQueue()
+
+    @contextmanager
+    def acquire(self):
+        try:
+            ydl = self._idle.get_nowait()
+        except queue.Empty:
+            ydl = yt_dlp.YoutubeDL(dict(self.opts))
+        # Checked out by one download at a time; callers set outtmpl before downloading
+        try:
+            yield ydl
+        finally:
+            self._idle.put(ydl)
+
+ydl_pool = YoutubeDLPool(YDL_OPTS)
+
+# Telegram file_ids of videos already uploaded, keyed by numeric TikTok video ID
+VIDEO_CACHE_FILE = os.getenv('VIDEO_CACHE_FILE', 'cache.json')
+VIDEO_CACHE_SIZE = int(os.getenv('VIDEO_CACHE_SIZE', '1000'))
+video_cache: "OrderedDict[str, str]" = OrderedDict()
+
+def remember_video(video_id: str, file_id: str):
+    video_cache[video_id] = file_id
+    video_cache.move_to_end(video_id)
+    while len(video_cache) > VIDEO_CACHE_SIZE:
+        video_cache.popitem(last=False)
+
+def load_video_cache():
+    try:
+        with open(VIDEO_CACHE_FILE) as f:
+            for video_id, file_id in json.load(f).items():
+                remember_video(video_id, file_id)
+        logger.info(f"Loaded {len(video_cache)} cached videos")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not load video cache: {str(e)}")
+
+def save_video_cache():
+    try:
+        with open(VIDEO_CACHE_FILE, 'w') as f:
+            json.dump(video_cache, f)
+    except OSError as e:
+        logger.error(f"Could not save video cache: {str(e)}")
+
+# Short-link token -> canonical /video/<id> URL, so short links hit video_cache too
+short_links: "OrderedDict[str, str]" = OrderedDict()
+# Shared keep-alive client for redirect lookups
+http_client = httpx.AsyncClient(
+    follow_redirects=True,
+    timeout=10,
+    headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'}
+)
+
+async def resolve_short_link(url: str) -> str:
+    """Follow a vm./vt./t/ TikTok link to its canonical video URL"""
+    match = SHORT_LINK_RE.search(url)
+    if not match or VIDEO_ID_RE.search(url):
+        return url
+    # Host plus token, so vm./vt./t/ tokens can't collide
+    token = match.group(0)
+    if token in short_links:
+        short_links.move_to_end(token)
+        return short_links[token]
+
+    try:
+        response = await http_client.head(url)
+    except httpx.HTTPError as e:
+        logger.warning(f"Could not resolve short link {url}: {str(e)}")
+        return url
+    resolved = str(response.url)
+    if not VIDEO_ID_RE.search(resolved):
+        return url
+
+    short_links[token] = resolved
+    while len(short_links) > VIDEO_CACHE_SIZE:
+        short_links.popitem(last=False)
+    return resolved
+
+async def on_shutdown(application):
+    save_video_cache()
+    await http_client.aclose()
+
+# Bot API refuses uploads above this size
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+# PTB forces a 20 s write timeout on multipart requests unless the call passes its own
+UPLOAD_READ_TIMEOUT = 60
+UPLOAD_WRITE_TIMEOUT = 120
+
+# TikTok's CDN throttles per connection, so large files are fetched in parallel ranges,
+# RANGE_CONNECTIONS at a time per download
+RANGE_CONNECTIONS = int(os.getenv('RANGE_CONNECTIONS', '4'))
+RANGE_CHUNK_BYTES = 1024 * 1024
+CONTENT_RANGE_RE = re.compile(r'bytes \d+-\d+/(\d+)')
+range_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS * RANGE_CONNECTIONS, thread_name_prefix="range")
+
+class VideoTooLargeError(Exception):
+    pass
+
+class FetchedVideo(NamedTuple):
+    data: bytes
+    # Extension of the file as fetched; the disk fallback may yield webm etc.
+    ext: str
+    # Time TikTok took to answer extraction; unlike the whole job it doesn't scale with file size
+    extract_seconds: float
+
+# Per-chat directories already created, so repeat requests skip the mkdir
+_created_dirs: set = set()
+
 class TikTokDownloader:
     def __init__(self, save_path: str = "downloads"):
         self.save_path = save_path
-        os.makedirs(self.save_path, exist_ok=True)
+        if save_path not in _created_dirs:
+            os.makedirs(self.save_path, exist_ok=True)
+            _created_dirs.add(save_path)
+
+    def fetch_video(self, url: str) -> FetchedVideo:
+        """Fetch a TikTok video into memory, going through disk only when yt-dlp must process it"""
+        with ydl_pool.acquire() as ydl:
+            start = time.monotonic()
+            info = ydl.extract_info(url, download=False)
+            extract_seconds = time.monotonic() - start
+            # Merged or non-HTTP formats need the on-disk path
+            if (info.get('requested_formats') or info.get('ext') != 'mp4'
+                    or info.get('protocol') not in ('http', 'https')):
+                return self._download_info(ydl, info, extract_seconds)
+            if (info.get('filesize') or 0) > MAX_UPLOAD_BYTES:
+                raise VideoTooLargeError("Video is larger than Telegram's 50 MB limit")
+
+            data = self._fetch_media(ydl, info['url'], info.get('http_headers') or {})
+            logger.info(f"Fetched {len(data)} bytes into memory: {url}")
+            return FetchedVideo(data, 'mp4', extract_seconds)
+
+    def _fetch_media(self, ydl, url: str, headers: dict) -> bytes:
+        """Fetch the media URL, over several ranged connections when the CDN allows it"""
+        first_range = {**headers, 'Range': f'bytes=0-{RANGE_CHUNK_BYTES - 1}'}
+        with ydl.urlopen(Request(url, headers=first_range)) as response:
+            if response.status == 200:
+                # Range ignored, the body is the whole file
+                return self._read_capped(response)
+            content_range = CONTENT_RANGE_RE.fullmatch(response.headers.get('Content-Range', ''))
+            data = bytearray(response.read()) if response.status == 206 and content_range else None
 
-    def download_video(self, url: str) -> Optional[str]:
-        """Download a TikTok video"""
+        if data is None:
+            # Partial reply without a usable total size: fetch the whole file in one request
+            with ydl.urlopen(Request(url, headers=headers)) as response:
+                if response.status != 200:
+                    raise Exception(f"Unexpected HTTP {response.status} fetching video")
+                return self._read_capped(response)
+
+        total = int(content_range.group(1))
+        if total > MAX_UPLOAD_BYTES:
+            raise VideoTooLargeError("Video is larger than Telegram's 50 MB limit")
+
+        # yt-dlp's networking is thread-safe (its own concurrent fragment downloads share
+        # one YoutubeDL), so the range threads can all use this checked-out instance
+        def read_range(start: int) -> bytes:
+            end = min(start + RANGE_CHUNK_BYTES, total) - 1
+            with ydl.urlopen(Request(url, headers={**headers, 'Range': f'bytes={start}-{end}'})) as part:
+                return part.read()
+
+        # Sliding window: at most RANGE_CONNECTIONS ranges in flight for this download,
+        # collected in order so chunks reassemble in place
+        pending = deque()
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_template = os.path.join(self.save_path, f"tiktok_{timestamp}.%(ext)s")
-            
-            ydl_opts = {
-                'format': 'best',
-                'outtmpl': output_template,
-                'quiet': False,
-                'no_warnings': False,
-                'merge_output_format': 'mp4',
-            }
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                downloaded_file = ydl.prepare_filename(info)
-                logger.info(f"Download completed: {downloaded_file}")
-                return downloaded_file
-        except Exception as e:
-            logger.error(f"Download failed: {str(e)}")
-            return None
+            for start in range(len(data), total, RANGE_CHUNK_BYTES):
+                if len(pending) >= RANGE_CONNECTIONS:
+                    data += pending.popleft().result()
+                pending.append(range_executor.submit(read_range, start))
+            while pending:
+                data += pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+        if len(data) != total:
+            raise Exception(f"Ranged download incomplete ({len(data)}/{total} bytes)")
+        return bytes(data)
+
+    def _read_capped(self, response) -> bytes:
+        if int(response.headers.get('Content-Length') or 0) > MAX_UPLOAD_BYTES:
+            raise VideoTooLargeError("Video is larger than Telegram's 50 MB limit")
+        data = bytearray()
+        while chunk := response.read(RANGE_CHUNK_BYTES):
+            data += chunk
+            if len(data) > MAX_UPLOAD_BYTES:
+                raise VideoTooLargeError("Video is larger than Telegram's 50 MB limit")
+        return bytes(data)
+
+    def _download_info(self, ydl, info: dict, extract_seconds: float) -> FetchedVideo:
+        """Download already-extracted info through a temporary file and return its bytes"""
+        # A private directory per download keeps names unique and is removed on exit
+        with tempfile.TemporaryDirectory(dir=self.save_path) as tmp_dir:
+            ydl.params['outtmpl'] = {'default': os.path.join(tmp_dir, "tiktok_%(id)s.%(ext)s")}
+            info = ydl.process_ie_result(info, download=True)
+            downloaded_file = ydl.prepare_filename(info)
+
+            # One stat covers both the existence and the size check
+            if os.stat(downloaded_file).st_size > MAX_UPLOAD_BYTES:
+                raise VideoTooLargeError("Video is larger than Telegram's 50 MB limit")
+            # PTB would read the file on the event loop, so read it here in one go
+            data = Path(downloaded_file).read_bytes()
+            logger.info(f"Download completed: {downloaded_file}")
+            return FetchedVideo(data, os.path.splitext(downloaded_file)[1].lstrip('.') or 'mp4', extract_seconds)
+
+# Fixed reply texts, built once
+START_TEXT = "Hello! Send me TikTok links to download them."
+DOWNLOAD_TEXT = "Just send me the TikTok URL directly!"
+SEND_URL_TEXT = "Send me a TikTok URL!"
+VIDEO_CAPTION = "Here's your TikTok video! 🎬"
 
 async def handle_tiktok_download(update: Update, context: ContextTypes.DEFAULT_TYPE, video_url: str):
     """Handle TikTok download with Telegram progress updates"""
     chat_id = update.effective_chat.id
+
+    # Already uploaded once: Telegram can resend it by file_id
+    video_url = await resolve_short_link(video_url)
+    video_id = extract_video_id(video_url)
+    if video_id and video_id in video_cache:
+        try:
+            await update.message.reply_video(
+                video=video_cache[video_id],
+                caption=VIDEO_CAPTION,
+                supports_streaming=True
+            )
+            video_cache.move_to_end(video_id)
+            return
+        except TelegramError as e:
+            # Fall through to a normal download; a stale or foreign file_id is also forgotten
+            logger.warning(f"Resending cached file_id for {video_id} failed: {str(e)}")
+            if isinstance(e, BadRequest):
+                video_cache.pop(video_id, None)
+
     message = await context.bot.send_message(chat_id, "⬇️ Starting download...")
-    
+
     try:
         # Initialize downloader
         downloader = TikTokDownloader(save_path=os.path.join("downloads", str(chat_id)))
         
-        # Update status
-        await context.bot.edit_message_text(
-            "⏳ Downloading video...",
-            chat_id=chat_id,
-            message_id=message.message_id
-        )
+        if download_limiter.locked():
+            await context.bot.edit_message_text(
+                "🕒 Waiting in queue...",
+                chat_id=chat_id,
+                message_id=message.message_id
+            )
+
+        async with download_limiter.slot() as sample:
+            # Update status
+            await context.bot.edit_message_text(
+                "⏳ Downloading video...",
+                chat_id=chat_id,
+                message_id=message.message_id
+            )
 
-        # Download video
-        video_path = downloader.download_video(video_url)
-        if not video_path or not os.path.exists(video_path):
-            raise Exception("Download failed")
+            # Download video, skipping the disk when no merge is needed
+            loop = asyncio.get_running_loop()
+            video = await loop.run_in_executor(download_executor, downloader.fetch_video, video_url)
+            sample['latency'] = video.extract_seconds
 
         # Upload to Telegram
         await context.bot.edit_message_text(
@@ -73,15 +399,17 @@ async def handle_tiktok_download(update: Update, context: ContextTypes.DEFAULT_T
             message_id=message.message_id
         )
 
-        with open(video_path, 'rb') as video_file:
-            await update.message.reply_video(
-                video=video_file,
-                caption="Here's your TikTok video! 🎬",
-                supports_streaming=True
-            )
+        sent = await update.message.reply_video(
+            video=video.data,
+            filename=f"tiktok_{video_id or 'video'}.{video.ext}",
+            caption=VIDEO_CAPTION,
+            supports_streaming=True,
+            read_timeout=UPLOAD_READ_TIMEOUT,
+            write_timeout=UPLOAD_WRITE_TIMEOUT
+        )
+        if video_id and sent.video:
+            remember_video(video_id, sent.video.file_id)
 
-        # Clean up
-        os.remove(video_path)
         await context.bot.delete_message(chat_id, message.message_id)
 
     except Exception as e:
@@ -96,21 +424,21 @@ async def handle_tiktok_download(update: Update, context: ContextTypes.DEFAULT_T
         except:
             await update.message.reply_text(error_msg)
 
-        if video_path and os.path.exists(video_path):
-            try:
-                os.remove(video_path)
-            except:
-                pass
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.effective_chat.send_message(START_TEXT)
+
+async def download(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(DOWNLOAD_TEXT)
+
+async def handle_tiktok_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # filters.Regex already matched the link, reuse its match object
+    video_url = context.matches[0].group(0)
+    if not video_url.startswith(('http://', 'https://')):
+        video_url = f"https://{video_url}"
+    await handle_tiktok_download(update, context, video_url)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    
-    # Check if it's a TikTok URL
-    if "tiktok.com" in text:
-        await handle_tiktok_download(update, context, text)
-        return
-    
-    await update.message.reply_text("Send me a TikTok URL!")
+    await update.message.reply_text(SEND_URL_TEXT)
 
 if __name__ == '__main__':
     # Get bot token from environment variable
@@ -119,19 +447,28 @@ if __name__ == '__main__':
         logger.error("BOT_TOKEN not found in environment variables!")
         exit(1)
     
-    app = ApplicationBuilder().token(bot_token).build()
+    load_video_cache()
+    # Larger keep-alive pool so parallel uploads reuse connections; these timeouts cover
+    # the non-upload calls, video uploads pass their own (see UPLOAD_WRITE_TIMEOUT)
+    app = (
+        ApplicationBuilder()
+        .token(bot_token)
+        # Handle updates concurrently so one download doesn't hold up other chats
+        .concurrent_updates(True)
+        .connection_pool_size(32)
+        .pool_timeout(30)
+        .read_timeout(UPLOAD_READ_TIMEOUT)
+        .write_timeout(UPLOAD_WRITE_TIMEOUT)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Add handlers
-    app.add_handler(CommandHandler("start", lambda update, context: context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="Hello! Send me TikTok links to download them."
-    )))
-    
-    app.add_handler(CommandHandler("download", lambda update, context: update.message.reply_text(
-        "Just send me the TikTok URL directly!"
-    )))
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("download", download))
 
-    # Message handler
+    # Message handlers: TikTok links first, everything else gets the hint
+    app.add_handler(MessageHandler(filters.Regex(TIKTOK_URL_RE) & ~filters.COMMAND, handle_tiktok_link))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
     app.run_polling()